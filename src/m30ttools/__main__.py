@@ -8,127 +8,536 @@ Some of the main subcommands are:
 
 
 import argparse
+import logging
 import os
 import csv
+import io
 import cv2
 import math
 import threading
 import queue
+import collections
+import functools
+import numpy as np
 import pandas as pd
 
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory, resource_tracker
+
 from .sync import extract_frames
-from .db import generate_hdf5_from_sync_frames, create_geotiff_from_jpg
+from .db import generate_hdf5_from_sync_frames, create_geotiff_from_jpg, image_corners
+
+log = logging.getLogger(__name__)
+
+
+def facing_down_columns(cols):
+    """Returns a mask of the flight data rows whose frames are facing down."""
+    pitch = cols["gimbal_pitch"]
+    return (-91 <= pitch) & (pitch <= -89)
+
+
+# Marks the end of the items in a queue.
+_STOP = object()
+
+
+# JPEG settings besides quality: baseline (non-progressive) encoding without
+# the Huffman optimization pass, the fastest libjpeg mode.
+_JPEG_PARAMS = [cv2.IMWRITE_JPEG_OPTIMIZE, 0, cv2.IMWRITE_JPEG_PROGRESSIVE, 0]
+
+
+# Scratch buffers reused across frames by each worker process (keyed by
+# shape and dtype) to avoid allocating intermediate arrays for every frame.
+_scratch = {}
+
+
+def _scratch_buffer(shape, dtype):
+    key = (shape, np.dtype(dtype))
+    buf = _scratch.get(key)
+    if buf is None:
+        buf = _scratch[key] = np.empty(shape, dtype=dtype)
+    return buf
+
+
+# Number of shared memory slots used to pass frames to the workers and
+# the maximum number of bytes they may take together.
+_SLOT_COUNT = 16
+_SLOT_BYTES = 256 << 20
+
+
+def _shared_memory_budget():
+    """Returns the number of bytes of shared memory the slots may use."""
+    budget = _SLOT_BYTES
+    try:
+        # Shared memory is backed by /dev/shm on Linux, which is small in
+        # containers.  Running out of it crashes the process with SIGBUS.
+        st = os.statvfs('/dev/shm')
+        budget = min(budget, st.f_bavail * st.f_frsize // 2)
+    except (AttributeError, OSError):
+        pass
+    return budget
 
 
-def facing_down(frame):
-    """Returns True if the frame is facing down."""
-    return -91 <= frame["camera"]["gimbal"]["pitch"] <= -89
+class _FrameSlots:
+    """Ring of shared memory blocks used to pass frames to the worker
+    processes without pickling them.
+
+    Blocks are allocated when the first frame is stored, sized after it,
+    as many as fit in the shared memory budget (up to _SLOT_COUNT).
+    `store` returns a reference to the frame that the workers resolve with
+    `_load_frame`, or the array itself (pickled to the workers) if no
+    block is free or can hold it.
+    """
+
+    def __init__(self, count=_SLOT_COUNT):
+        self._count = count
+        self._size = 0
+        self._blocks = []
+        self._free = collections.deque()
+        self._allocated = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def store(self, array):
+        if not self._allocated:
+            self._allocated = True
+            self._size = array.nbytes
+            count = min(self._count, _shared_memory_budget() // max(self._size, 1))
+            self._blocks = [shared_memory.SharedMemory(create=True, size=self._size)
+                            for _ in range(count)]
+            self._free.extend(range(count))
+
+        if array.nbytes > self._size or not self._free:
+            return array, None
+
+        slot = self._free.popleft()
+        block = self._blocks[slot]
+        np.copyto(np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf), array)
+        return (block.name, array.shape, array.dtype.str), slot
+
+    def release(self, slot):
+        if slot is not None:
+            self._free.append(slot)
+
+    def close(self):
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks = []
+
+
+# Shared memory blocks attached by each worker process, keyed by name.
+_attached = {}
+
+
+def _load_frame(frame):
+    """Returns the array of a frame passed to a worker process, either as
+    an array or as a reference to a shared memory block."""
+    if isinstance(frame, np.ndarray):
+        return frame
+
+    name, shape, dtype = frame
+    block = _attached.get(name)
+    if block is None:
+        block = _attached[name] = shared_memory.SharedMemory(name=name)
+    return np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+
+def _prepare_frame(frame, crop, array_size):
+    """Crops, converts and resizes a frame according to the command line
+    options.
+
+    The returned array may be a scratch buffer that is overwritten by the
+    next call, or a view of the input frame.
+    """
+    width, height, channels = array_size
+    array = _load_frame(frame)
+
+    if crop is not None:
+        # Crop frame (a view, no copy).
+        array = array[crop[0]:crop[1], crop[2]:crop[3]]
+
+    if array.ndim == 3 and array.shape[2] == 3 and channels == 1:
+        gray = _scratch_buffer(array.shape[:2], array.dtype)
+        array = cv2.cvtColor(array, cv2.COLOR_RGB2GRAY, dst=gray)
+
+    if array.shape[:2] != (height, width):
+        out = _scratch_buffer((height, width) + array.shape[2:], array.dtype)
+        array = cv2.resize(array, (width, height), dst=out,
+                           interpolation=cv2.INTER_AREA)
+
+    return array
+
+
+def _encode_frame(frame, crop, array_size, params):
+    """Prepares a frame and encodes it as JPEG with the given OpenCV
+    parameters, returning the encoded bytes.
+
+    This function runs in a worker process, so it must only receive
+    picklable arguments.  Writing the file is left to the caller.
+    """
+    ok, data = cv2.imencode('.jpg', _prepare_frame(frame, crop, array_size), params)
+    if not ok:
+        raise Exception('Could not encode frame as JPEG')
+    return data.tobytes()
+
+
+def _write_files(q: queue.Queue, errors: list):
+    """Writes (filename, data) pairs from the queue until _STOP is received.
+
+    Errors are appended to errors.  After an error, the remaining pairs are
+    discarded, so writers to the queue never block.
+    """
+    while True:
+        v = q.get()
+        if v is _STOP:
+            break
+        if errors:
+            continue
+        filename, data = v
+        try:
+            with open(filename, 'wb') as f:
+                f.write(data)
+        except Exception as e:
+            errors.append(e)
+
+
+class _NvJpegEncoder:
+    """Batched JPEG encoder running on the GPU (nvJPEG via torchvision).
+
+    Frames are copied into pinned host buffers, allocated once and reused,
+    uploaded in batches and encoded on the device.  Two CUDA streams (each
+    with its own buffers) are used round-robin, so that the upload and
+    encoding of a batch may overlap with the download and writing of the
+    previous one; the actual overlap has not been measured.
+    """
+
+    def __init__(self, write, quality, batch_size=32):
+        import torch
+        from torchvision.io import encode_jpeg
+
+        if not torch.cuda.is_available():
+            raise RuntimeError('CUDA is not available')
+
+        self._write = write
+        self._torch = torch
+        self._encode_jpeg = encode_jpeg
+        self._batch_size = batch_size
+        self._quality = quality
+        self._streams = [torch.cuda.Stream(), torch.cuda.Stream()]
+        self._buffers = [[None] * batch_size for _ in self._streams]
+        self._count = 0
+        self._batch = []
+        self._in_flight = None
+
+    def add(self, filename, array):
+        torch = self._torch
+
+        # The buffers of a stream are free again once its previous batch is
+        # finished, which happens before this batch is submitted.
+        buffers = self._buffers[self._count % len(self._streams)]
+        k = len(self._batch)
+        if buffers[k] is None or tuple(buffers[k].shape) != array.shape:
+            buffers[k] = torch.empty(array.shape, dtype=torch.uint8, pin_memory=True)
+        buffers[k].copy_(torch.from_numpy(array))
+
+        self._batch.append((filename, buffers[k]))
+        if len(self._batch) >= self._batch_size:
+            self._submit()
+
+    def close(self):
+        self._submit()
+        self._finish()
+
+    def _submit(self):
+        if not self._batch:
+            return
+
+        torch = self._torch
+        stream = self._streams[self._count % len(self._streams)]
+        self._count += 1
+
+        with torch.cuda.stream(stream):
+            images = []
+            for _, host in self._batch:
+                # OpenCV frames are BGR, nvJPEG expects RGB.  Channels are
+                # flipped on the device.
+                image = host.to('cuda', non_blocking=True).permute(2, 0, 1)
+                images.append(image.flip(0))
+            encoded = self._encode_jpeg(images, quality=self._quality)
+
+        filenames = [filename for filename, _ in self._batch]
+        self._batch = []
+
+        # Write the previous batch while this one is being encoded.
+        self._finish()
+        self._in_flight = (stream, filenames, encoded)
+
+    def _finish(self):
+        if self._in_flight is None:
+            return
+
+        stream, filenames, encoded = self._in_flight
+        self._in_flight = None
+
+        stream.synchronize()
+        for filename, data in zip(filenames, encoded):
+            self._write(filename, data.cpu().numpy().tobytes())
+
+
+def _make_encoder(name, write, quality, channels):
+    """Returns the batched encoder for the given name or None if frames
+    should be encoded with OpenCV.  Encoded frames are passed to write."""
+    if name == 'nvjpeg':
+        # The CUDA encoder of torchvision only accepts RGB images.
+        if channels != 3:
+            log.warning("nvJPEG encoder only supports 3 channels, falling back to OpenCV")
+            return None
+        try:
+            return _NvJpegEncoder(write, quality)
+        except (ImportError, RuntimeError) as e:
+            log.warning("nvJPEG encoder unavailable (%s), falling back to OpenCV", e)
+    return None
 
 
 def efcommand(args):
 
     # Creates frame directory if it doesn't exist.
-    frame_dir = args.frames_dir
-    if not os.path.exists(frame_dir):
-        os.makedirs(frame_dir)
+    os.makedirs(args.frames_dir, exist_ok=True)
 
     # Open CSV file to write frame information.
     output = args.output
 
-    if args.select == 'all':
-        args.select = lambda x: True
-    elif args.select == 'facing-down':
-        args.select = facing_down
+    # Frames are selected with vectorized conditions over the flight data
+    # columns of each video.
+    conditions = []
+
+    if args.select == 'facing-down':
+        conditions.append(facing_down_columns)
 
     if args.min_altitude is not None:
-        f = args.select
-        args.select = lambda frame: f(frame) and frame["geoposition"]["ground_level_altitude"] >= args.min_altitude
+        conditions.append(lambda cols: cols["ground_level_altitude"] >= args.min_altitude)
+
+    def select(cols):
+        mask = np.ones(len(cols["time"]), dtype=bool)
+        for condition in conditions:
+            mask &= condition(cols)
+        return mask
+
+    workers = args.workers or os.cpu_count() or 1
+
+    # Frames are encoded by the worker processes while the CSV file is
+    # written here, so rows keep the extraction order.  Only a couple of
+    # frames per worker are kept in flight to bound memory usage.  Frames
+    # are passed through a fixed number of shared memory slots, and pickled
+    # when none is free.
+    max_pending = 2 * workers
+
+    with open(output, 'w', buffering=1 << 20) as csvfile, \
+            ProcessPoolExecutor(max_workers=workers) as executor, \
+            _FrameSlots() as slots:
+        # Workers must share the resource tracker of this process, otherwise
+        # each one starts its own when attaching to a shared memory block and
+        # it unlinks the block when the worker exits.
+        if os.name == 'posix':
+            resource_tracker.ensure_running()
+
+        # The worker processes are started by the first submission.  Start
+        # them now, before any thread is running, since forking a
+        # multithreaded process may deadlock.
+        executor.submit(int).result()
+
+        # Rows are formatted into an in-memory buffer that is flushed to the
+        # file in large blocks.
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(('filename', 'video_filename', 'time', 'datetime', 'latitude', 'longitude',
+                         'ground_level_altitude', 'sea_level_altitude',
+                         'gimbal_pitch', 'gimbal_roll', 'gimbal_yaw'))
+
+        def flush_rows():
+            csvfile.write(buf.getvalue())
+            buf.seek(0)
+            buf.truncate(0)
+
+        errors = []
+        stop = threading.Event()
+
+        def produce_frames(q: queue.Queue):
+            frames = extract_frames(args.video, args.data,
+                                    None, args.min_time, args.hwaccel,
+                                    cond_vec=select if conditions else None)
+            try:
+                for i, frame in enumerate(frames):
+                    if stop.is_set():
+                        break
+                    q.put((i, frame))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                frames.close()
+                q.put(_STOP)
+
+        # The queue is bounded so the producer blocks when frames are not
+        # consumed fast enough, capping the number of decoded frames in
+        # memory.
+        q = queue.Queue(maxsize=8)
 
-    with open(output, 'w') as csvfile:
-        fieldnames = ['filename', 'video_filename', 'time', 'datetime', 'latitude', 'longitude',
-                      'ground_level_altitude', 'sea_level_altitude',
-                      'gimbal_pitch', 'gimbal_roll', 'gimbal_yaw']
+        p = threading.Thread(target=produce_frames, args=(q,))
+        p.start()
 
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
+        # Encoded frames are written to disk by a dedicated thread, so
+        # encoding the next frames overlaps with the writes.
+        wq = queue.Queue(maxsize=64)
 
-        def produce_frames(q: queue.Queue):
-            for i, frame in enumerate(extract_frames(args.video, args.data,
-                    args.select, args.min_time)):
-                q.put((i, frame))
-            q.put(None)
+        w = threading.Thread(target=_write_files, args=(wq, errors))
+        w.start()
+
+        # When a batched encoder is used, the workers only prepare the frames.
+        pending = collections.deque()
+
+        # Set once the producer has sent _STOP.
+        produced = False
+
+        try:
+            encoder = _make_encoder(args.encoder, lambda filename, data: wq.put((filename, data)),
+                                    args.jpeg_quality, args.array_size[2])
+            jpeg_params = [cv2.IMWRITE_JPEG_QUALITY, args.jpeg_quality] + _JPEG_PARAMS
+
+            def drain():
+                # Fail early if a frame could not be written.
+                if errors:
+                    raise errors[0]
+                filename, future, slot = pending.popleft()
+                result = future.result()
+                slots.release(slot)
+                if encoder is None:
+                    wq.put((filename, result))
+                else:
+                    encoder.add(filename, result)
+
+            # Frame filenames share the same encoded directory prefix.
+            prefix = os.fsencode(args.frames_dir + "/")
 
-        def consume_frames(q: queue.Queue):
             while True:
                 v = q.get()
-                if v is None:
-                    q.task_done()
+                if v is _STOP:
+                    produced = True
                     break
                 i, frame = v
-                save_frame(i, frame)
-                q.task_done()
-
-        def save_frame(i, frame):
-            # TODO: read number of digits from command line as an optional
-            # argument.
-            filename = f"{args.frames_dir}/{i:07d}.jpg"
-
-            writer.writerow({
-                'filename': filename,
-                'video_filename': frame["video_filename"],
-                'time': frame["time"],
-                'datetime': frame["datetime"].isoformat(),
-                'latitude': frame["geoposition"]["latitude"],
-                'longitude': frame["geoposition"]["longitude"],
-                'ground_level_altitude': frame["geoposition"]["ground_level_altitude"],
-                'sea_level_altitude': frame["geoposition"]["sea_level_altitude"],
-                'gimbal_pitch': frame["camera"]["gimbal"]["pitch"],
-                'gimbal_roll': frame["camera"]["gimbal"]["roll"],
-                'gimbal_yaw': frame["camera"]["gimbal"]["yaw"],
-            })
-
-            array = frame["array"]
-            array_size = args.array_size
-
-            if args.crop is not None:
-                # Crop frame.
-                array = array[args.crop[0]:args.crop[1], args.crop[2]:args.crop[3]]
-
-            if array.shape[2] == 3 and array_size[2] == 1:
-                array = cv2.cvtColor(array, cv2.COLOR_RGB2GRAY)
-
-            if array.shape[0] != array_size[0] or array.shape[1] != array_size[1]:
-                array = cv2.resize(array, (array_size[0], array_size[1]))
-
-            # Save frame to disk asy
-            cv2.imwrite(filename, array)
-
-        q = queue.Queue()
 
-        p = threading.Thread(target=produce_frames, args=(q,))
-        p.start()
+                # TODO: read number of digits from command line as an optional
+                # argument.
+                filename = os.fsdecode(b"%s%07d.jpg" % (prefix, i))
+
+                geo = frame.geoposition
+                gimbal = frame.camera.gimbal
+
+                # Fields must follow the header order.
+                writer.writerow((
+                    filename,
+                    frame.video_filename,
+                    frame.time,
+                    frame.datetime.isoformat(),
+                    geo.latitude,
+                    geo.longitude,
+                    geo.ground_level_altitude,
+                    geo.sea_level_altitude,
+                    gimbal.pitch,
+                    gimbal.roll,
+                    gimbal.yaw,
+                ))
+
+                if buf.tell() > 65536:
+                    flush_rows()
+
+                if len(pending) >= max_pending:
+                    drain()
+
+                shared, slot = slots.store(frame.array)
+
+                if encoder is None:
+                    future = executor.submit(_encode_frame, shared,
+                                             args.crop, args.array_size, jpeg_params)
+                else:
+                    future = executor.submit(_prepare_frame, shared,
+                                             args.crop, args.array_size)
+                pending.append((filename, future, slot))
+
+            flush_rows()
+
+            while pending:
+                drain()
+
+            if encoder is not None:
+                encoder.close()
+        finally:
+            # On errors, frames that were not encoded yet are dropped and the
+            # producer is stopped, unblocking it if the queue is full.
+            for _, future, _ in pending:
+                future.cancel()
+
+            stop.set()
+            while not produced:
+                produced = q.get() is _STOP
 
-        c = threading.Thread(target=consume_frames, args=(q,))
-        c.start()
+            wq.put(_STOP)
 
-        p.join()
-        c.join()
-        q.join()
+            p.join()
+            w.join()
+
+        if errors:
+            raise errors[0]
 
 
 def h5command(args):
 
-    generate_hdf5_from_sync_frames(args.data, args.output)
+    generate_hdf5_from_sync_frames(args.data, args.output, args.compression)
+
+
+def _one_geotiff(output_dir, dfov, size, row, corners):
+    # Each worker process compresses with a single thread, otherwise the
+    # processes together would start one thread per CPU each.
+    create_geotiff_from_jpg(row['filename'], output_dir, dfov, row, corners=corners,
+                            num_threads=1, corners_size=size)
 
 
 def geotiffcommand(args):
 
+    # Creates output directory if it doesn't exist.
+    os.makedirs(args.output_dir, exist_ok=True)
+
     # Read CSV file
     df = pd.read_csv(args.data)
 
-    for _, row in df.iterrows():
-        filename = row['filename']
-        create_geotiff_from_jpg(filename, args.output_dir, args.dfov, row)
+    # Only facing-down frames can be georeferenced.
+    mask = df['gimbal_pitch'].between(-91, -89)
+    if not mask.all():
+        log.info("Skipping %d frames because gimbal_pitch is not -90 degrees", (~mask).sum())
+        df = df.loc[mask]
+
+    if df.empty:
+        return
+
+    # Corners of all images are computed at once.  Frames extracted by
+    # extract-frames share the same size, so it is taken from the first one.
+    # Workers compute the corners again for images of other sizes.
+    first = cv2.imread(df['filename'].iloc[0], cv2.IMREAD_UNCHANGED)
+    if first is None:
+        raise Exception(f"Could not read image: {df['filename'].iloc[0]}")
+
+    height, width = first.shape[:2]
+    corners = image_corners(df, args.dfov, width, height)
+
+    # Each GeoTIFF is independent, so they are generated in parallel.  Rows
+    # are sent to the workers in chunks to amortize the communication.
+    rows = (row._asdict() for row in df.itertuples(index=False))
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        list(executor.map(functools.partial(_one_geotiff, args.output_dir, args.dfov, (width, height)),
+                          rows, corners, chunksize=32))
 
 
 def main():
@@ -182,6 +591,24 @@ def main():
         type=int,
         default=(160, 90, 3))
 
+    # Hardware accelerated video decoding (e.g. 'cuda', 'vaapi' or
+    # 'videotoolbox').  Falls back to software decoding if unavailable.
+    efparser.add_argument('--hwaccel', dest='hwaccel', default=None,
+                          help='Hardware acceleration device type used to decode the videos.')
+
+    # Number of worker processes used to encode the extracted frames.
+    efparser.add_argument('--workers', dest='workers', type=int, default=None,
+                          help='Number of processes used to encode frames (defaults to the number of CPUs).')
+
+    # JPEG encoder.  'nvjpeg' encodes frames in batches on the GPU and falls
+    # back to OpenCV when CUDA is not available.
+    efparser.add_argument('--encoder', dest='encoder', default='opencv',
+                          choices=['opencv', 'nvjpeg'],
+                          help='JPEG encoder used to save the frames.')
+
+    efparser.add_argument('--jpeg-quality', dest='jpeg_quality', type=int, default=85,
+                          help='JPEG quality (0-100) of the saved frames.')
+
     efparser.set_defaults(func=efcommand)
 
     h5parser = subparsers.add_parser('h5store',
@@ -196,6 +623,10 @@ def main():
         help='HDF5 filename where to save the flight data.',
         required=True)
 
+    h5parser.add_argument('--compression', dest='compression', default=None,
+                          choices=['lzf', 'gzip'],
+                          help='Compression filter for the frames (default: none).')
+
     h5parser.set_defaults(func=h5command)
 
     # XXX: at the moment, only facing-down is supported.
@@ -211,9 +642,16 @@ def main():
     geotiffparser.add_argument('--dfov', dest='dfov', type=float,
                                help='Diagonal field of view of the camera in degrees.', required=True)
 
+    geotiffparser.add_argument('--workers', dest='workers', type=int, default=None,
+                               help='Number of processes used to generate GeoTIFFs (defaults to the number of CPUs).')
+
     geotiffparser.set_defaults(func=geotiffcommand)
 
     args = parser.parse_args()
+
+    # Progress and warnings from the library are reported through logging.
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+
     args.func(args)
 
 
@@ -2,25 +2,55 @@
 
 
 import os
+import collections
+import itertools
 import pandas as pd
 import numpy as np
 import cv2
 import h5py
 import rasterio
-from geographiclib.geodesic import Geodesic
+from rasterio.enums import ColorInterp
+from pyproj import Geod
 import math
+import functools
+
+from concurrent.futures import ThreadPoolExecutor
+
+def _to_records(df: pd.DataFrame) -> np.recarray:
+    """Convert a dataframe to a record array that can be stored in HDF5.
+
+    String columns are stored as UTF-8 encoded fixed-length byte strings.
+    """
+    arrays = []
+    for column in df.columns:
+        values = df[column].to_numpy()
+        if values.dtype == object:
+            values = np.char.encode(values.astype(str), 'utf-8')
+        arrays.append(values)
+
+    return np.rec.fromarrays(arrays, names=list(df.columns))
+
 
 def generate_hdf5_from_sync_frames(
         csv_filename: str,
-        hdf5_filename: str):
+        hdf5_filename: str,
+        compression: str = None):
     """Generate HDF5 from synchronized data.
 
+    All frames are stored in a single ``frames`` dataset of shape
+    ``(N, height, width[, channels])``.  The i-th frame filename is stored
+    in ``filename[i]`` and the remaining columns of the CSV file in the
+    compound dataset ``meta[i]``.
+
     Parameters
     ----------
     csv_filename : str
         CSV filename contained synchronized frames.
     hdf5_filename : str
         Output HDF5 filename.
+    compression : str, optional
+        HDF5 compression filter for the frames (e.g. 'lzf').  If None,
+        frames are stored uncompressed for faster writes.
     """
 
     # Read CSV file
@@ -30,21 +60,135 @@ def generate_hdf5_from_sync_frames(
     if os.path.exists(hdf5_filename):
         raise Exception(f'HDF5 file already exists: {hdf5_filename}')
 
-    with h5py.File(hdf5_filename, 'w') as f:
-        for _, row in df.iterrows():
-            filename = row['filename']
-            array = cv2.imread(filename, cv2.IMREAD_UNCHANGED)
+    filenames = df['filename'].tolist()
+
+    # Frames are decoded ahead in a thread pool (OpenCV releases the GIL)
+    # while HDF5 writes stay in this thread, since h5py does not support
+    # concurrent writes.
+    prefetch = 16
+
+    # The latest file format version has cheaper metadata, and a larger
+    # chunk cache keeps several frames in memory while they are written.
+    with h5py.File(hdf5_filename, 'w', libver='latest', track_order=False,
+                   rdcc_nbytes=64 << 20) as f, \
+            ThreadPoolExecutor(max_workers=8) as executor:
+        filename_iter = iter(filenames)
+        pending = collections.deque(
+            executor.submit(cv2.imread, filename, cv2.IMREAD_UNCHANGED)
+            for filename in itertools.islice(filename_iter, prefetch))
+
+        dset = None
+        for i, filename in enumerate(filenames):
+            array = pending.popleft().result()
+            next_filename = next(filename_iter, None)
+            if next_filename is not None:
+                pending.append(executor.submit(cv2.imread, next_filename, cv2.IMREAD_UNCHANGED))
+
+            if array is None:
+                raise Exception(f'Could not read frame: {filename}')
+
+            # Frames are written one at a time into a preallocated dataset
+            # whose shape is given by the first frame.
+            if dset is None:
+                dset = f.create_dataset('frames', shape=(len(filenames),) + array.shape,
+                                        dtype=array.dtype, chunks=(1,) + array.shape,
+                                        compression=compression)
+            elif array.shape != dset.shape[1:]:
+                raise Exception(f'Frame {filename} has shape {array.shape}, expected {dset.shape[1:]}')
+
+            dset[i] = array
+
+        f.create_dataset('filename', data=filenames, dtype=h5py.string_dtype())
+        f.create_dataset('meta', data=_to_records(df.drop(columns=['filename'])))
+
+
+# Same ellipsoid as EPSG:4326.
+_GEOD = Geod(ellps='WGS84')
+
+
+@functools.lru_cache(maxsize=None)
+def _ground_distance_ratio(dfov: float) -> float:
+    """Ratio between the ground distance from the center to a corner of a
+    nadir image and the altitude."""
+
+    # By the sine rule, we have:
+    #   d / sin(dfov / 2) = h / sin(90 - dfov / 2)
+    # Now, we can solve for d / h:
+    dfov = math.radians(dfov)
+    return math.sin(dfov / 2) / math.sin(math.pi / 2 - dfov / 2)
+
+
+@functools.lru_cache(maxsize=None)
+def _corner_offsets(width: int, height: int) -> tuple:
+    """Angles (radians) of the corners of an image in relation to its
+    center, in the order top left, top right, bottom right, bottom left."""
+
+    # to find the angle of the top right pixel in relation to the center,
+    # we use the ratio between width and height
+    theta = math.atan(width / height)
+    return (-theta, theta, math.pi - theta, math.pi + theta)
+
+
+def image_corners(flight_data, dfov: float, width: int, height: int) -> np.ndarray:
+    """Compute the geographic coordinates of the corners of nadir images.
+
+    Parameters
+    ----------
+    flight_data : dict or pandas.DataFrame
+        Synced flight data with fields 'latitude', 'longitude',
+        'ground_level_altitude' and 'gimbal_yaw'.  Fields may be scalars
+        (one image) or columns (many images computed at once).
+
+    dfov : float
+        Camera diagonal field of view (degrees).
 
-            dset = f.create_dataset(filename, data=array)
+    width, height : int
+        Image size in pixels.
 
-            for column in df.columns:
-                if column != 'filename':
-                    dset.attrs[column] = row[column]
+    Returns
+    -------
+    numpy.ndarray
+        Array of shape (..., 4, 2) with the (longitude, latitude) of the
+        top left, top right, bottom right and bottom left corners.
+    """
 
+    latitude = np.asarray(flight_data['latitude'], dtype=float)
+    longitude = np.asarray(flight_data['longitude'], dtype=float)
+
+    # Altitude
+    h = np.asarray(flight_data['ground_level_altitude'], dtype=float)
 
-def create_geotiff_from_jpg(jpg_image_path, output_dir, dfov, flight_data):
+    # Distance from the center to the corners on the ground.
+    d = h * _ground_distance_ratio(dfov)
+
+    # Now, we can calculate the position of the corners of the image
+    # in the camera coordinate system
+    # gimbal_yaw is Yaw angle of the gimbal (degrees). 0 represents north and increases eastward.
+    yaw = np.radians(np.asarray(flight_data['gimbal_yaw'], dtype=float))
+
+    # Trigonometric constants only depend on dfov and the image size, so
+    # they are cached across calls.
+    offsets = np.array(_corner_offsets(width, height))
+
+    # Now we can calculate the coordinates of the corners, assuming center of
+    # the image is at (latitude, longitude).  All corners of all images are
+    # solved in a single call.
+    azimuth = np.degrees(yaw[..., None] + offsets)
+    lon, lat, az, dist = np.broadcast_arrays(longitude[..., None], latitude[..., None],
+                                             azimuth, d[..., None])
+    lon2, lat2, _ = _GEOD.fwd(lon.ravel(), lat.ravel(), az.ravel(), dist.ravel())
+
+    return np.stack([lon2, lat2], axis=-1).reshape(az.shape + (2,))
+
+
+def create_geotiff_from_jpg(jpg_image_path, output_dir, dfov, flight_data, corners=None,
+                            num_threads='all_cpus', corners_size=None):
     """Create GeoTIFF from JPG image.
 
+    The image is assumed to be taken facing down, that is, with gimbal
+    pitch close to -90 degrees.  Callers are expected to filter out other
+    frames.
+
     Parameters
     ----------
     jpg_path : str
@@ -62,67 +206,70 @@ def create_geotiff_from_jpg(jpg_image_path, output_dir, dfov, flight_data):
                     'datetime', 'latitude', 'longitude',
                     'ground_level_altitude', 'sea_level_altitude',
                     'gimbal_pitch', 'gimbal_roll', 'gimbal_yaw'
-    """
 
-    if flight_data['gimbal_pitch'] < -91 or flight_data['gimbal_pitch'] > -89:
-        # print warning message and returns
-        print(f"Skipping {jpg_image_path} because gimbal_pitch is not -90 degrees")
-        return
+    corners : numpy.ndarray, optional
+        Corners of the image as returned by `image_corners`.  If None, they
+        are computed from flight_data.
 
-    output_filename = os.path.join(output_dir, os.path.basename(jpg_image_path).replace('.jpg', '.tif'))
+    num_threads : int or str, optional
+        Number of threads used to compress the GeoTIFF, or 'all_cpus'.
+        Use 1 when generating several GeoTIFFs in parallel.
 
-    with rasterio.open(jpg_image_path, 'r') as src:
-        jpg_image_array = src.read()
-        width, height = src.width, src.height
-        channels_count = src.count
-        channels_indexes = src.indexes
+    corners_size : tuple[int, int], optional
+        Image (width, height) the given corners were computed for.  If the
+        image has a different size, the corners are computed again.
+    """
 
-    # Altitude
-    h = flight_data['ground_level_altitude']
+    output_filename = os.path.join(output_dir, os.path.basename(jpg_image_path).replace('.jpg', '.tif'))
 
-    # By the sine rule, we have:
-    #   d / sin(dfov / 2) = h / sin(90 - dfov / 2)
-    # Now, we can solve for d:
-    dfov = math.radians(dfov)
-    d = h * math.sin(dfov / 2) / math.sin(math.pi / 2 - dfov / 2)
+    # OpenCV decodes JPEG faster than GDAL.  Its (height, width[, channels])
+    # BGR layout is converted to the (channels, height, width) RGB layout
+    # rasterio expects.
+    jpg_image_array = cv2.imread(jpg_image_path, cv2.IMREAD_UNCHANGED)
+    if jpg_image_array is None:
+        raise Exception(f'Could not read image: {jpg_image_path}')
 
-    # Now, we can calculate the position of the corners of the image
-    # in the camera coordinate system
-    # gimbal_yaw is Yaw angle of the gimbal (degrees). 0 represents north and increases eastward.
-    yaw = math.radians(flight_data['gimbal_yaw'])
+    if jpg_image_array.ndim == 2:
+        jpg_image_array = jpg_image_array[None]
+    else:
+        jpg_image_array = jpg_image_array[:, :, ::-1].transpose(2, 0, 1)
 
-    # to find the angle of the top right pixel in relation to the center,
-    # we use the ratio between width and height
-    theta = math.atan(width / height)
-    top_right_yaw = math.degrees(yaw + theta)
-    # the remaining corners are:
-    top_left_yaw = math.degrees(yaw - theta)
-    bottom_right_yaw = math.degrees(yaw + math.pi - theta)
-    bottom_left_yaw = math.degrees(yaw + math.pi + theta)
+    channels_count, height, width = jpg_image_array.shape
+    channels_indexes = list(range(1, channels_count + 1))
 
-    # Now we can calculate the coordinates of the corners, assuming center of
-    # the image is at (frame.latitute, flight_data['longitude'])
-    geod = Geodesic.WGS84 # Same thing as EPSG:4326
-    top_right = geod.Direct(flight_data['latitude'], flight_data['longitude'], top_right_yaw, d)
-    bottom_right = geod.Direct(flight_data['latitude'], flight_data['longitude'], bottom_right_yaw, d)
-    bottom_left = geod.Direct(flight_data['latitude'], flight_data['longitude'], bottom_left_yaw, d)
-    top_left = geod.Direct(flight_data['latitude'], flight_data['longitude'], top_left_yaw, d)
+    if corners is None or (corners_size is not None and tuple(corners_size) != (width, height)):
+        corners = image_corners(flight_data, dfov, width, height)
+
+    top_left, top_right, bottom_right, bottom_left = corners
 
     crs = 'EPSG:4326'
     gcps = [
-        rasterio.control.GroundControlPoint(0, 0, top_left['lon2'], top_left['lat2']),
-        rasterio.control.GroundControlPoint(width, 0, top_right['lon2'], top_right['lat2']),
-        rasterio.control.GroundControlPoint(width, height, bottom_right['lon2'], bottom_right['lat2']),
-        rasterio.control.GroundControlPoint(0, height, bottom_left['lon2'], bottom_left['lat2']),
+        rasterio.control.GroundControlPoint(0, 0, *top_left),
+        rasterio.control.GroundControlPoint(width, 0, *top_right),
+        rasterio.control.GroundControlPoint(width, height, *bottom_right),
+        rasterio.control.GroundControlPoint(0, height, *bottom_left),
     ]
 
     transform = rasterio.transform.from_gcps(gcps)
 
+    # The image is fully opaque, so instead of an all-255 alpha band the
+    # bands just get their color interpretation.
+    if channels_count == 3:
+        colorinterp = [ColorInterp.red, ColorInterp.green, ColorInterp.blue]
+    else:
+        colorinterp = [ColorInterp.gray] * channels_count
+
+    # Tiles are at most 512x512 (a multiple of 16, as required by TIFF), so
+    # small frames are not padded to a huge tile.
+    blockxsize = min(512, 16 * math.ceil(width / 16))
+    blockysize = min(512, 16 * math.ceil(height / 16))
+
     with rasterio.open(output_filename, 'w', driver='GTiff', width=width,
-            height=height, count=channels_count+1, dtype=str(jpg_image_array.dtype),
-                       crs=crs, transform=transform) as dst:
+            height=height, count=channels_count, dtype=str(jpg_image_array.dtype),
+                       crs=crs, transform=transform,
+                       tiled=True, blockxsize=blockxsize, blockysize=blockysize,
+                       compress='deflate', predictor=2, num_threads=num_threads,
+                       bigtiff='no') as dst:
+        dst.colorinterp = colorinterp
         dst.write(jpg_image_array, channels_indexes)
         dst.update_tags(AUTHOR='verri/m30ttools', CAPTURE_TIMESTAMP=flight_data['datetime'])
-        # Create alpha band
-        alpha = np.full((height, width), 255, dtype=np.uint8)
-        dst.write(alpha, 4)
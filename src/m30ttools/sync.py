@@ -6,25 +6,326 @@ This submodule contains some utility functions to synchronize the captured
 videos and flight data.
 """
 
-import cv2
+import av
 import pandas as pd
 import numpy as np
 
-from datetime import datetime
-
+import os
 import math
+import logging
+import queue
+import functools
+import threading
+import weakref
 
 from collections.abc import Generator
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
+from numpy.typing import NDArray
 from typing import Callable
 
 from .typing import Frame
 
 from alive_progress import alive_bar
 
+log = logging.getLogger(__name__)
+
+# Flight data columns used to build the frames and the names they are
+# extracted as.
+_COLUMNS = {
+    "time(millisecond)": "time",
+    "datetime(utc)": "datetime",
+    "latitude": "latitude",
+    "longitude": "longitude",
+    "height_above_ground_at_drone_location(meters)": "ground_level_altitude",
+    "altitude_above_seaLevel(meters)": "sea_level_altitude",
+    "gimbal_pitch(degrees)": "gimbal_pitch",
+    "gimbal_roll(degrees)": "gimbal_roll",
+    "gimbal_heading(degrees)": "gimbal_yaw",
+}
+
+# Types of the numeric flight data columns that are read.  Columns not in
+# _COLUMNS or isVideo are skipped when parsing.
+_DTYPES = {
+    "isVideo": "int8",
+    "time(millisecond)": "int64",
+    "latitude": "float64",
+    "longitude": "float64",
+    "height_above_ground_at_drone_location(meters)": "float64",
+    "altitude_above_seaLevel(meters)": "float64",
+    "gimbal_pitch(degrees)": "float64",
+    "gimbal_roll(degrees)": "float64",
+    "gimbal_heading(degrees)": "float64",
+}
+
+
+def _read_flight_data(filename: str) -> pd.DataFrame:
+    """Reads the needed columns of an airdata.com CSV file."""
+    return pd.read_csv(filename, engine="pyarrow", usecols=["isVideo", *_COLUMNS],
+                       dtype=_DTYPES)
+
+
+# Number of decoded frames the video workers may keep ahead of the
+# consumer, shared by all of them.  Part of them is reserved to the video
+# being yielded, so later videos decoding ahead cannot starve it.
+_BUFFER_SIZE = 16
+_BUFFER_RESERVED = 4
+
+# Maximum number of videos decoded at the same time.  Each decoder is
+# multithreaded, so a few of them are enough to keep all cores busy.
+_MAX_WORKERS = 4
+
+# Marks the end of the frames of a video.
+_STOP = object()
+
+# Targets at most this far (milliseconds) ahead of the last decoded frame
+# are reached by decoding forward instead of seeking, since a seek restarts
+# decoding from the previous keyframe.
+_MAX_DECODE_AHEAD = 2000
+
+
+def _open_container(path: str, hwaccel: str = None):
+    """Opens a video with the given hardware acceleration device type (e.g.
+    'cuda', 'vaapi' or 'videotoolbox'), falling back to software decoding
+    if it is not available."""
+    if hwaccel is not None:
+        try:
+            from av.codec.hwaccel import HWAccel
+            return av.open(path, hwaccel=HWAccel(device_type=hwaccel,
+                                                 allow_software_fallback=True))
+        except Exception as e:
+            log.warning("hardware acceleration '%s' unavailable (%s), decoding in software", hwaccel, e)
+
+    return av.open(path)
+
+
+class _VideoReader:
+    """Reads the frames of a video at given times with PyAV.
+
+    Reading increasing, close enough times decodes the video sequentially;
+    only the returned frames are converted to arrays.  Reads are serialized
+    by a lock, so a reader can be shared by several threads.  The video is
+    closed when the reader is garbage collected.
+    """
+
+    def __init__(self, path: str, hwaccel: str = None, threads: int = 0):
+        self._container = _open_container(path, hwaccel)
+        self._stream = self._container.streams.video[0]
+        self._lock = threading.Lock()
+        self._finalizer = weakref.finalize(self, self._container.close)
+
+        # Decode with the given number of threads (0 lets FFmpeg decide).
+        self._stream.thread_type = "AUTO"
+        self._stream.codec_context.thread_count = threads
+
+        self._frames = None
+        self._reset()
+
+    def _reset(self):
+        self._frame = None
+        self._frame_time = -math.inf
+        self._prev_time = -math.inf
+
+    def _seek(self, time: float):
+        stream = self._stream
+        start = stream.start_time or 0
+
+        # Seek to the keyframe before the target.
+        self._container.seek(start + int(time / 1000 / stream.time_base), stream=stream)
+        self._frames = self._container.decode(stream)
+        self._reset()
+
+    def close(self):
+        with self._lock:
+            self._finalizer()
+
+    def read(self, time: float):
+        """Returns the first frame at or after time (milliseconds) as a BGR
+        array, or None if there is no such frame."""
+        with self._lock:
+            return self._read(time)
+
+    def _read(self, time: float):
+        # The last decoded frame is the one requested.
+        if self._prev_time < time <= self._frame_time:
+            return self._frame.to_ndarray(format="bgr24")
+
+        if self._frames is None or time < self._frame_time or \
+                time - self._frame_time > _MAX_DECODE_AHEAD:
+            self._seek(time)
+
+        stream = self._stream
+        start = stream.start_time or 0
+
+        for frame in self._frames:
+            if frame.pts is None:
+                continue
+
+            self._prev_time = self._frame_time
+            self._frame_time = float((frame.pts - start) * stream.time_base) * 1000
+            self._frame = frame
+
+            if self._frame_time >= time:
+                return frame.to_ndarray(format="bgr24")
+
+        # End of the video.
+        self._frames = None
+        self._reset()
+        return None
+
+
+@functools.lru_cache(maxsize=8)
+def _open_video(path: str, hwaccel: str = None, threads: int = 0) -> _VideoReader:
+    """Returns a reader for the video, reusing recently opened ones.
+
+    Opening a video probes the container and sets up the decoder, so readers
+    are kept open across calls.  Evicted readers are closed once no longer
+    in use.
+    """
+    return _VideoReader(path, hwaccel, threads)
+
+
+@contextmanager
+def _video_reader(path: str, hwaccel: str = None, threads: int = 0):
+    """Context manager for the reader of a video.
+
+    The reader stays cached for later use if the block succeeds.  On
+    error, it may be left mid-stream or broken, so it is closed right away
+    and the cached readers are dropped.
+    """
+    reader = _open_video(path, hwaccel, threads)
+    try:
+        yield reader
+    except BaseException:
+        _open_video.cache_clear()
+        reader.close()
+        raise
+
+
+def _select_frames(video: str, df: pd.DataFrame, cond, cond_vec, min_time) -> list[Frame]:
+    """Selects the frames of a video from its flight data, sorted by time."""
+
+    # Columns are extracted once as NumPy arrays, so the loop below only
+    # does integer indexing.
+    cols = {name: df[column].to_numpy() for column, name in _COLUMNS.items()}
+
+    # Datetimes are parsed in a single vectorized pass.
+    cols["datetime"] = pd.to_datetime(cols["datetime"], format="%Y-%m-%d %H:%M:%S",
+                                      cache=True).to_pydatetime()
+    n = df.shape[0]
+
+    selected = []
+    last_time = -math.inf
+
+    # Rows are filtered all at once when a vectorized condition is given.
+    rows = range(n) if cond_vec is None else np.flatnonzero(cond_vec(cols))
+
+    for k in rows:
+        frame = Frame(cols, k, video)
+
+        if cond is not None and not cond(frame):
+            continue
+
+        # Discard frames that are too close to each other.
+        if frame.time - last_time < min_time:
+            continue
+
+        last_time = frame.time
+
+        selected.append(frame)
+
+    # Decoding in increasing time order means the reader never seeks
+    # backwards.  The sort is stable and flight data is usually already
+    # sorted by time, in which case the order is unchanged.
+    selected.sort(key=lambda frame: frame.time)
+
+    return selected
+
+
+class _FrameBudget:
+    """Limits the number of decoded frames waiting to be yielded.
+
+    Workers take a token for each frame they decode and the consumer gives
+    it back when the frame leaves the buffer.  The worker of the current
+    video (the one being yielded) may use every token, while workers of
+    later videos leave the reserved ones free.
+    """
+
+    def __init__(self, size: int, reserved: int):
+        self._size = size
+        self._reserved = reserved
+        self._used = 0
+        self._current = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, i: int, stop: threading.Event) -> bool:
+        """Takes a token for the i-th video.  Returns False if stop is set
+        before a token is available."""
+        with self._cond:
+            while not stop.is_set():
+                limit = self._size if i <= self._current else self._size - self._reserved
+                if self._used < limit:
+                    self._used += 1
+                    return True
+                self._cond.wait(0.1)
+            return False
+
+    def release(self):
+        with self._cond:
+            self._used -= 1
+            self._cond.notify_all()
+
+    def advance(self, i: int):
+        """Marks the i-th video as the one being yielded."""
+        with self._cond:
+            self._current = i
+            self._cond.notify_all()
+
+
+def _decode_video(i: int, video: str, selected: list[Frame], hwaccel, threads: int,
+                  q: queue.Queue, budget: _FrameBudget, stop: threading.Event):
+    """Decodes the selected frames of the i-th video, sending them to q.
+
+    Frames are sent as None if they do not exist in the video, each one
+    after taking a token from budget, followed by _STOP.  An error is sent
+    instead of the remaining items.  Stops early if stop is set.
+    """
+
+    try:
+        if stop.is_set():
+            return
+
+        log.info("Processing video %s...", video)
+
+        # Load the video
+        with _video_reader(video, hwaccel, threads) as reader:
+            for frame in selected:
+                if not budget.acquire(i, stop):
+                    return
+
+                # Read the frame (seeking only if needed)
+                array = reader.read(frame.time)
+
+                if array is None:
+                    log.warning("frame at %s does not exist in video %s", frame.time, video)
+                    frame = None
+                else:
+                    frame.array = array
+
+                q.put(frame)
+
+        q.put(_STOP)
+    except Exception as e:
+        q.put(e)
+
+
 def extract_frames(videos: list[str], filenames: list[str],
                    cond: Callable[[Frame], bool] = None,
-                   min_time: int = 0) -> Generator[Frame, None, None]:
+                   min_time: int = 0,
+                   hwaccel: str = None,
+                   cond_vec: Callable[[dict[str, NDArray]], NDArray[np.bool_]] = None
+                   ) -> Generator[Frame, None, None]:
     """Extract frames from videos and synchronize them with flight data
 
     Videos and flight data are assumed to be ordered by collection time.
@@ -42,106 +343,104 @@ def extract_frames(videos: list[str], filenames: list[str],
         returned, False otherwise. If None, all frames are returned.
     min_time : int
         Minimum time between frames in milliseconds
+    hwaccel : str, optional
+        Hardware acceleration device type used to decode the videos (e.g.
+        'cuda', 'vaapi' or 'videotoolbox').  If None or not available, videos
+        are decoded in software.
+    cond_vec : Callable[[dict[str, NDArray]], NDArray[np.bool_]], optional
+        Vectorized version of cond.  It takes the flight data columns of a
+        video (see `Frame` for the keys) and returns a boolean mask of the
+        rows whose frames should be returned.  It is evaluated once per video,
+        before cond, so only the selected rows are turned into frames.
 
     Returns
     -------
     Generator[Frame, None, None]
-        A generator that yields frames
+        A generator that yields frames, as views over the flight data of
+        each video.  Frames are yielded video by video, in increasing time
+        order within each video.
     """
 
-    # Load all datafiles in a single dataframe
-    fdata = pd.concat([pd.read_csv(filename) for filename in filenames])
+    # Load all datafiles in a single dataframe, keeping track of the file
+    # each row comes from.
+    fdata = pd.concat([_read_flight_data(filename).assign(_file_id=j)
+                       for j, filename in enumerate(filenames)], ignore_index=True)
 
     # Every time the variable isVideo changes (from 0 to 1), we know a new
     # video exists. We can use this to split the dataframe into multiple data
     # frames that match each video.
 
-    # Find the indices where the variable isVideo changes
-    indices = np.where(np.diff(fdata.isVideo) == 1)[0]
+    # Find the indices where the variable isVideo changes (the first row of
+    # each video), without materializing the differences.
+    isv = fdata["isVideo"].to_numpy(dtype=np.uint8, copy=False)
+    indices = np.flatnonzero(isv[1:] & ~isv[:-1]) + 1
 
-    print(indices)
+    log.debug("isVideo transitions: %s", indices)
     assert len(indices) == 0 or len(indices) == len(videos)
 
-    # Split the dataframe into multiple dataframes
+    # Label each row with the video it belongs to: a new video starts at
+    # every change.  If there are no changes, each file is already related
+    # to a video.
     if len(indices) > 0:
-        fdata = np.vsplit(fdata, indices)
+        video_id = np.zeros(len(isv), dtype=np.intp)
+        video_id[indices] = 1
+        np.cumsum(video_id, out=video_id)
     else:
-        # otherwise, each dataframe is already related to a video
-        fdata = [pd.read_csv(filename) for filename in filenames]
-        # XXX: loading the datasets again is an ugly hack, but it works
+        video_id = fdata["_file_id"].to_numpy()
 
     # Now remove all rows that are not related to the video, that is, remove
-    # rows such that isVideo is 0
-    fdata = [df[df.isVideo == 1] for df in fdata]
-    fdata = [df for df in fdata if df.shape[0] > 0]
+    # rows such that isVideo is 0, and split the remaining rows by video in a
+    # single pass.
+    keep = isv == 1
+    fdata = [df for _, df in fdata[keep].groupby(video_id[keep], sort=False)]
 
     # The column "time(millisecond)" of each dataframe must start at 0
     for df in fdata:
         df["time(millisecond)"] -= df["time(millisecond)"].iloc[0]
 
-    last_video = ""
-    last_time = -math.inf
-
-    # Now we can iterate over the videos and synchronize them with the flight
-    for i in range(len(videos)):
-        print(f"Processing video {videos[i]} ({i + 1}/{len(videos)})...")
-        # Load the video
-        cap = cv2.VideoCapture(videos[i])
-
-        # Create a progress bar
-        with alive_bar(fdata[i].shape[0]) as bar:
-            for _, row in fdata[i].iterrows():
-                bar()
-                time = row["time(millisecond)"]
-
-                geoposition = {
-                    "latitude": row["latitude"],
-                    "longitude": row["longitude"],
-                    "ground_level_altitude": row["height_above_ground_at_drone_location(meters)"],
-                    "sea_level_altitude": row["altitude_above_seaLevel(meters)"],
-                }
-
-                # TODO: retrieve camera information from the video file
-                camera = {
-                    "model": "(unknown)",
-                    "focal_length": math.nan,
-                    "sensor_width": math.nan,
-                    "sensor_height": math.nan,
-                    "gimbal": {
-                        "pitch": row["gimbal_pitch(degrees)"],
-                        "roll": row["gimbal_roll(degrees)"],
-                        "yaw": row["gimbal_heading(degrees)"],
-                    },
-                }
-
-                # Create the frame
-                frame = {
-                    "video_filename": videos[i],
-                    "array": None,
-                    "time": time,
-                    "datetime": datetime.strptime(row["datetime(utc)"], "%Y-%m-%d %H:%M:%S"),
-                    "geoposition": geoposition,
-                    "camera": camera,
-                }
-
-                if cond is not None and not cond(frame):
-                    continue
-
-                # Discard frames that are too close to each other.
-                if frame["video_filename"] == last_video and \
-                        frame["time"] - last_time < min_time:
-                    continue
-
-                last_video = frame["video_filename"]
-                last_time = frame["time"]
-
-                # Seek to the frame
-                cap.set(cv2.CAP_PROP_POS_MSEC, time)
-                ret, array = cap.read()
-
-                if array is None:
-                    print(f"warning: frame at {time} does not exist in video {videos[i]}")
-                    continue
-
-                frame["array"] = array
-                yield frame
+    if len(fdata) < len(videos):
+        raise Exception(f"Flight data has {len(fdata)} video segments, expected {len(videos)}")
+
+    # Frames are selected beforehand, so the total is known.
+    selected = [_select_frames(video, df, cond, cond_vec, min_time)
+                for video, df in zip(videos, fdata)]
+
+    # Videos are decoded in parallel, each one by a worker thread (PyAV
+    # releases the GIL while decoding).  Frames are yielded in video order:
+    # workers of later videos decode ahead into their queues, and the
+    # budget caps the frames buffered by all of them to _BUFFER_SIZE.  The
+    # CPUs are split among the decoders.
+    cpus = os.cpu_count() or 1
+    workers = max(min(len(videos), cpus, _MAX_WORKERS), 1)
+    threads = 0 if workers == 1 else max(cpus // workers, 1)
+
+    queues = [queue.Queue() for _ in videos]
+    budget = _FrameBudget(_BUFFER_SIZE, _BUFFER_RESERVED)
+    stop = threading.Event()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            for i, video in enumerate(videos):
+                executor.submit(_decode_video, i, video, selected[i], hwaccel, threads,
+                                queues[i], budget, stop)
+
+            with alive_bar(sum(len(frames) for frames in selected)) as bar:
+                for i, q in enumerate(queues):
+                    budget.advance(i)
+
+                    while True:
+                        frame = q.get()
+                        if frame is _STOP:
+                            break
+                        if isinstance(frame, Exception):
+                            raise frame
+
+                        budget.release()
+                        bar()
+
+                        # Missing frames are sent as None.
+                        if frame is not None:
+                            yield frame
+        finally:
+            # Stop the workers if the generator is closed early.
+            stop.set()
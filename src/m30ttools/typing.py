@@ -1,10 +1,13 @@
+import math
 import numpy as np
 
+from dataclasses import dataclass, field, asdict
+from datetime import datetime
 from numpy.typing import NDArray
-from typing import TypedDict
 
 
-class Geoposition(TypedDict):
+@dataclass(slots=True, frozen=True)
+class Geoposition:
     latitude: float
     """Latitude in degrees"""
 
@@ -17,8 +20,13 @@ class Geoposition(TypedDict):
     sea_level_altitude: float
     """Absolute altitude in meters"""
 
+    def as_dict(self) -> dict:
+        """Returns the geoposition as a dictionary."""
+        return asdict(self)
 
-class Gimbal(TypedDict):
+
+@dataclass(slots=True, frozen=True)
+class Gimbal:
     pitch: float
     """Pitch angle in degrees"""
 
@@ -28,36 +36,99 @@ class Gimbal(TypedDict):
     yaw: float
     """Yaw angle in degrees"""
 
+    def as_dict(self) -> dict:
+        """Returns the gimbal angles as a dictionary."""
+        return asdict(self)
+
 
-class Camera(TypedDict):
-    model: str
+@dataclass(slots=True, frozen=True)
+class Camera:
+    # Camera information is not known yet, so these fields default to
+    # placeholders shared by all instances.
+    model: str = field(default="(unknown)", kw_only=True)
     """Camera model"""
 
-    focal_length: float
+    focal_length: float = field(default=math.nan, kw_only=True)
     """Focal length in millimeters"""
 
-    sensor_width: float
+    sensor_width: float = field(default=math.nan, kw_only=True)
     """Sensor width in millimeters"""
 
-    sensor_height: float
+    sensor_height: float = field(default=math.nan, kw_only=True)
     """Sensor height in millimeters"""
 
     gimbal: Gimbal
     """Gimbal angles"""
 
+    def as_dict(self) -> dict:
+        """Returns the camera information as a dictionary."""
+        return asdict(self)
+
+
+class Frame:
+    """Frame backed by the flight data columns of its video.
+
+    Fields are read on access from arrays shared by all the frames of a
+    video (keyed by 'time', 'datetime', 'latitude', 'longitude',
+    'ground_level_altitude', 'sea_level_altitude', 'gimbal_pitch',
+    'gimbal_roll' and 'gimbal_yaw'), so creating a view copies no data.
+
+    Use `as_dict` where a mapping is needed.
+    """
+
+    __slots__ = ("_cols", "_k", "array", "video_filename")
+
+    _FIELDS = ("video_filename", "array", "time", "datetime", "geoposition", "camera")
 
-class Frame(TypedDict):
     video_filename: str
     """Video filename"""
 
     array: NDArray[np.uint8]
     """Frame as a numpy array"""
 
-    time: int
-    """Time (in milliseconds) of the frame in the video"""
-
-    geoposition: Geoposition
-    """Geoposition of the drone when the frame was captured"""
-
-    camera: Camera
-    """Camera information"""
+    def __init__(self, cols: dict[str, NDArray], k: int, video_filename: str,
+                 array: NDArray[np.uint8] = None):
+        self._cols = cols
+        self._k = k
+        self.video_filename = video_filename
+        self.array = array
+
+    @property
+    def time(self) -> int:
+        """Time (in milliseconds) of the frame in the video"""
+        return self._cols["time"][self._k]
+
+    @property
+    def datetime(self) -> datetime:
+        """Date and time (UTC) when the frame was captured"""
+        return self._cols["datetime"][self._k]
+
+    @property
+    def geoposition(self) -> Geoposition:
+        """Geoposition of the drone when the frame was captured"""
+        cols, k = self._cols, self._k
+        return Geoposition(
+            latitude=cols["latitude"][k],
+            longitude=cols["longitude"][k],
+            ground_level_altitude=cols["ground_level_altitude"][k],
+            sea_level_altitude=cols["sea_level_altitude"][k],
+        )
+
+    @property
+    def camera(self) -> Camera:
+        """Camera information"""
+        cols, k = self._cols, self._k
+        # TODO: retrieve camera information from the video file
+        return Camera(gimbal=Gimbal(
+            pitch=cols["gimbal_pitch"][k],
+            roll=cols["gimbal_roll"][k],
+            yaw=cols["gimbal_yaw"][k],
+        ))
+
+    def as_dict(self) -> dict:
+        """Returns the frame as a dictionary, with nested dictionaries for
+        the geoposition and camera information."""
+        d = {key: getattr(self, key) for key in self._FIELDS}
+        d["geoposition"] = d["geoposition"].as_dict()
+        d["camera"] = d["camera"].as_dict()
+        return d